@@ -1,39 +1,122 @@
 import argparse
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import lru_cache
+import os
 from random import choice
+import shelve
 import sys
+import threading
+from typing import Iterator, Optional
 
 import chess
 import openai
+from openai import OpenAI, Stream
+from openai.types.chat import ChatCompletionChunk
 
 N_RANKS = 8
 N_FILES = 8
 MODEL = "gpt-3.5-turbo-0301"
+SYSTEM_PROMPT = "You play chess as {color}. Line 1: best move in SAN, nothing else. Line 2: brief reason, no board. Board: KQRBNP white, kqrbnp black, '.' empty, rank 8 on top, files a-h left to right. The user's moves then follow as 'Move: <SAN>'."
+CACHE_PATH = os.path.expanduser("~/.cache/chessgpt")
+CACHE_LOCK = threading.Lock()
+MAX_RETRIES = 4
+PIECES = "KQRBN"
+FILES = "abcdefgh"
+RANKS = "12345678"
+SAN_START = PIECES + FILES + "O0o"
+TOP_EDGE = " ┌───┬───┬───┬───┬───┬───┬───┬───┐"
+MID_EDGE = " ├───┼───┼───┼───┼───┼───┼───┼───┤"
+BOT_EDGE = " └───┴───┴───┴───┴───┴───┴───┴───┘"
+FILES_LABEL = "   a   b   c   d   e   f   g   h"
+SQUARES_TOP_DOWN = [
+    [chess.square(j, N_RANKS - i - 1) for j in range(N_FILES)] for i in range(N_RANKS)
+]
 
 
 def render(board: chess.Board) -> str:
     lines: list[str] = []
-    for i in range(N_RANKS):
-        pieces = [
-            board.piece_at(chess.square(j, N_RANKS - i - 1)) for j in range(N_FILES)
-        ]
-        chars = map(
-            lambda piece: piece.unicode_symbol() if piece is not None else " ",
-            pieces,
-        )
-        line = f"{N_RANKS - i}│ "
-        line += " │ ".join(chars)
-        line += " │"
-        lines.append(line)
+    piece_map = board.piece_map()
+    for i, squares in enumerate(SQUARES_TOP_DOWN):
+        pieces = [piece_map.get(square) for square in squares]
+        chars = [piece.unicode_symbol() if piece else " " for piece in pieces]
+        lines.append(f"{N_RANKS - i}│ {' │ '.join(chars)} │")
         if i < N_RANKS - 1:
-            lines.append(" ├───┼───┼───┼───┼───┼───┼───┼───┤")
+            lines.append(MID_EDGE)
     if board.turn == chess.BLACK:
         lines.reverse()
-    lines.insert(0, " ┌───┬───┬───┬───┬───┬───┬───┬───┐")
-    lines.append(" └───┴───┴───┴───┴───┴───┴───┴───┘")
-    lines.append("   a   b   c   d   e   f   g   h")
+    lines.insert(0, TOP_EDGE)
+    lines.extend((BOT_EDGE, FILES_LABEL))
     return "\n".join(lines)
 
 
+def scan_castling(s: str, i: int) -> Optional[str]:
+    c = s[i]
+    j = i + 1
+    rooks = 1
+    while j + 1 < len(s) and s[j] == "-" and s[j + 1] == c and rooks < 3:
+        j += 2
+        rooks += 1
+    if rooks == 2:
+        return "O-O"
+    if rooks == 3:
+        return "O-O-O"
+    return None
+
+
+def is_san_body(body: str) -> bool:
+    """Checks for an optional origin file and rank, capture and destination square."""
+    if len(body) < 2 or body[-2] not in FILES or body[-1] not in RANKS:
+        return False
+    origin = body[:-2]
+    if origin.endswith("x"):
+        origin = origin[:-1]
+    if len(origin) > 2 or "x" in origin:
+        return False
+    return len(origin) < 2 or (origin[0] in FILES and origin[1] in RANKS)
+
+
+def scan_san(s: str) -> Optional[str]:
+    """Returns the first token in s shaped like a SAN move or None."""
+    n = len(s)
+    i = 0
+    while i < n:
+        c = s[i]
+        if c not in SAN_START:
+            i += 1
+            continue
+        if c in "O0o":
+            san = scan_castling(s, i)
+            if san is not None:
+                j = i + len(san)
+                if j < n and s[j] in "+#":
+                    san += s[j]
+                return san
+            i += 1
+            continue
+
+        # piece, then the run of file/rank/capture characters up to the destination
+        j = i + 1 if c in PIECES else i
+        k = j
+        while k < n and k - j < 5 and (s[k] in FILES or s[k] in RANKS or s[k] == "x"):
+            k += 1
+        # back off to the longest prefix of the run that ends on a destination
+        body = s[j:k]
+        while body and not is_san_body(body):
+            body = body[:-1]
+        if not body:
+            i += 1
+            continue
+        k = j + len(body)
+
+        # promotion and check suffixes
+        if k + 1 < n and s[k] == "=" and s[k + 1] in "QRBN":
+            k += 2
+        if k < n and s[k] in "+#":
+            k += 1
+        return s[i:k]
+    return None
+
+
 def get_user_move(board: chess.Board) -> chess.Move:
     san = input("\nYour next move: ")
     while True:
@@ -54,7 +137,7 @@ def get_ai_prompt(color: str, board_str: str) -> list[dict[str, str]]:
     return [
         {
             "role": "system",
-            "content": f"You are a chess bot playing as {color}. You reply with the optimal next move in standard algebraic chess notation on the first line and nothing else and on the second line an explanation of the move but without reprinting the board. The user will give you a chess board configuration, where each piece is represented by a single character. The uppercase letters represent the white pieces (K for king, Q for queen, R for rook, B for bishop, N for knight and P for pawn), while the corresponding lowercase letters represent the black pieces. The dots represent empty squares on the board. The ranks are numbered from 1 to 8, and the files are labeled from a to h.",
+            "content": SYSTEM_PROMPT.format(color=color),
         },
         {"role": "assistant", "content": "Ok."},
         {
@@ -64,47 +147,284 @@ def get_ai_prompt(color: str, board_str: str) -> list[dict[str, str]]:
     ]
 
 
-def send_ai_prompt(prompt: list[dict[str, str]]) -> tuple[str, str]:
-    response = openai.ChatCompletion.create(
+def stream_explanation(
+    rest: str, response: Stream[ChatCompletionChunk], index: int
+) -> Iterator[str]:
+    """Yields the rest of the streamed choice index with blank lines dropped."""
+    # a trailing line break is held back until more text follows, so that the
+    # explanation is stripped of line breaks at both ends like the reply used to be
+    started = False
+    pending = ""
+    try:
+        while True:
+            while "\n\n" in rest:
+                rest = rest.replace("\n\n", "\n")
+            if pending or not started:
+                rest = rest.lstrip("\n")
+            line_break = rest.endswith("\n")
+            if line_break:
+                rest = rest[:-1]
+            if rest:
+                yield pending + rest
+                started = True
+                pending = "\n" if line_break else ""
+            elif line_break:
+                pending = "\n"
+            chunk = next(response, None)
+            if chunk is None:
+                return
+            rest = "".join(
+                candidate.delta.content or ""
+                for candidate in chunk.choices
+                if candidate.index == index
+            )
+    finally:
+        response.close()
+
+
+def first_lines(
+    response: Stream[ChatCompletionChunk],
+    stop: Optional[threading.Event] = None,
+) -> Iterator[tuple[int, str, str]]:
+    """Yields index, first line and remaining text of each choice once its line ends."""
+    # only the new delta is searched for the line break, not the whole head
+    heads: dict[int, Optional[list[str]]] = {}
+    for chunk in response:
+        if stop is not None and stop.is_set():
+            return
+        for candidate in chunk.choices:
+            head = heads.setdefault(candidate.index, [])
+            if head is None:
+                continue
+            delta = candidate.delta.content or ""
+            if "\n" not in delta:
+                head.append(delta)
+                continue
+            before, _, rest = delta.partition("\n")
+            head.append(before)
+            heads[candidate.index] = None
+            yield candidate.index, "".join(head), rest
+    # replies without a line break end with the stream
+    for index, head in heads.items():
+        if head is not None:
+            yield index, "".join(head), ""
+
+
+def send_ai_prompt(
+    client: OpenAI, prompt: list[dict[str, str]], n: int = 1
+) -> Stream[ChatCompletionChunk]:
+    return client.chat.completions.create(
         model=MODEL,
         messages=prompt,
+        n=n,
+        stream=True,
     )
-    reply: str = response["choices"][0]["message"]["content"]
-    lines = reply.splitlines()
-    san = lines[0]
-    explanation = "\n".join([line for line in lines[1:] if line != ""])
-    return san, explanation
-
-
-def get_ai_move(board: chess.Board, max_tries: int) -> tuple[chess.Move, str]:
-    color = "white" if board.turn == chess.WHITE else "black"
-    prompt = get_ai_prompt(color, str(board))
-    for _ in range(max_tries):
-        san, explanation = send_ai_prompt(prompt)
+
+
+# the cache is best effort, a broken or locked cache file means no caching
+@lru_cache(maxsize=None)
+def open_cache() -> Optional[shelve.Shelf]:
+    try:
+        os.makedirs(os.path.dirname(CACHE_PATH), exist_ok=True)
+        return shelve.open(CACHE_PATH)
+    except Exception:
+        return None
+
+
+def read_cache(key: str) -> Optional[tuple[str, str]]:
+    with CACHE_LOCK:
+        cache = open_cache()
+        if cache is None:
+            return None
         try:
-            move = board.parse_san(san)
-            return move, explanation
-        except StopIteration:
-            continue
-        except ValueError:
+            san, explanation = cache[key]
+            return san, explanation
+        except Exception:
+            return None
+
+
+def write_cache(key: str, san: str, explanation: str) -> None:
+    with CACHE_LOCK:
+        cache = open_cache()
+        if cache is None:
+            return
+        try:
+            cache[key] = (san, explanation)
+            cache.sync()
+        except Exception:
+            pass
+
+
+def cache_explanation(key: str, san: str, explanation: Iterator[str]) -> Iterator[str]:
+    """Passes the explanation through and caches the reply once it is complete."""
+    parts: list[str] = []
+    for text in explanation:
+        parts.append(text)
+        yield text
+    write_cache(key, san, "".join(parts))
+
+
+def is_plausible(board: chess.Board, san: str) -> bool:
+    """Cheaply rejects SAN whose piece cannot reach the destination square."""
+    if san[0] == "O":
+        return True
+    destination = san.rstrip("+#").partition("=")[0][-2:]
+    square = chess.parse_square(destination)
+    if board.color_at(square) == board.turn:
+        return False
+    if san[0] not in PIECES:
+        return True
+    piece_type = chess.PIECE_SYMBOLS.index(san[0].lower())
+    pieces = board.pieces_mask(piece_type, board.turn)
+    return bool(board.attackers_mask(board.turn, square) & pieces)
+
+
+def parse_move(board: chess.Board, san: str) -> Optional[chess.Move]:
+    """Parses SAN into a move, rejecting the null move "--" as no move at all."""
+    try:
+        move = board.parse_san(san)
+    except ValueError:
+        return None
+    return move if move else None
+
+
+def parse_ai_move(board: chess.Board, line: str) -> Optional[tuple[str, chess.Move]]:
+    """Parses the move from the first line of an AI reply."""
+    # compliant replies are just the move, only scan the line when they are not,
+    # move numbers, markdown and annotations like in "1... **Nf6!**" are dropped
+    san = line.strip().strip("*`")
+    if san[:1].isdigit():
+        san = san.rpartition(".")[2].strip()
+    san = san.rstrip(".!?")
+    move = parse_move(board, san)
+    if move is not None:
+        return san, move
+    san = scan_san(line)
+    if san is None or not is_plausible(board, san):
+        return None
+    move = parse_move(board, san)
+    if move is None:
+        return None
+    return san, move
+
+
+def cache_key(board: chess.Board) -> str:
+    return f"{MODEL}|{board.epd()}"
+
+
+def get_ai_move(
+    client: OpenAI,
+    board: chess.Board,
+    history: list[dict[str, str]],
+    max_tries: int,
+    stop: Optional[threading.Event] = None,
+) -> tuple[chess.Move, Iterator[str]]:
+    key = cache_key(board)
+    cached = read_cache(key)
+    if cached is not None:
+        san, explanation = cached
+        move = parse_move(board, san)
+        if move is not None:
+            return move, iter([explanation])
+    # all tries are sampled in one request, the first valid move wins
+    response = send_ai_prompt(client, history, n=max_tries)
+    for index, line, rest in first_lines(response, stop):
+        parsed = parse_ai_move(board, line)
+        if parsed is None:
             continue
-    return chess.Move.null(), "AI did not make a valid move."
+        san, move = parsed
+        explanation = stream_explanation(rest, response, index)
+        return move, cache_explanation(key, san, explanation)
+    response.close()
+    return chess.Move.null(), iter(["AI did not make a valid move."])
 
 
-def authenticate() -> None:
-    if openai.api_key is None:
+def predict_user_move(board: chess.Board) -> Optional[chess.Move]:
+    """Guesses the user's reply: a forced move or the cheapest recapture."""
+    # there is nothing to recapture at the start or after the AI passed
+    if not board.move_stack or not board.peek():
+        return None
+    moves = list(board.legal_moves)
+    if len(moves) == 1:
+        return moves[0]
+    target = board.peek().to_square
+    recaptures = [move for move in moves if move.to_square == target]
+    if not recaptures:
+        return None
+    return min(recaptures, key=lambda move: board.piece_type_at(move.from_square))
+
+
+def prefetch_ai_move(
+    client: OpenAI,
+    board: chess.Board,
+    history: list[dict[str, str]],
+    max_tries: int,
+    stop: threading.Event,
+) -> None:
+    """Reads a whole AI reply so that it ends up in the cache, unless stopped."""
+    if stop.is_set():
+        return
+    # speculation is best effort, the live request takes over on any failure
+    try:
+        client = client.with_options(max_retries=0)
+        _, explanation = get_ai_move(client, board, history, max_tries, stop)
+        for _ in explanation:
+            if stop.is_set():
+                break
+    except Exception:
+        pass
+
+
+def speculate(
+    executor: ThreadPoolExecutor,
+    client: OpenAI,
+    board: chess.Board,
+    history: list[dict[str, str]],
+    max_tries: int,
+) -> Optional[tuple[str, Future, threading.Event]]:
+    """Starts prefetching the AI reply to the predicted user move, if there is one."""
+    guess = predict_user_move(board)
+    if guess is None:
+        return None
+    message = {"role": "user", "content": f"Move: {board.san(guess)}"}
+    ahead = board.copy()
+    ahead.push(guess)
+    stop = threading.Event()
+    future = executor.submit(
+        prefetch_ai_move, client, ahead, history + [message], max_tries, stop
+    )
+    return cache_key(ahead), future, stop
+
+
+def authenticate() -> OpenAI:
+    api_key = os.environ.get("OPENAI_API_KEY")
+    if api_key is None:
         print("OpenAI API key not found in environment variable 'OPENAI_API_KEY'.")
-        openai.api_key = input("Enter your OpenAI key manually: ")
+        api_key = input("Enter your OpenAI key manually: ")
+    # one HTTP/2 connection is shared by all requests, the client retries with backoff
+    client = OpenAI(
+        api_key=api_key,
+        max_retries=MAX_RETRIES,
+        http_client=openai.DefaultHttpxClient(http2=True),
+    )
     try:
-        openai.Model.retrieve(MODEL)
-    except openai.error.AuthenticationError as err:
+        client.models.retrieve(MODEL)
+    except openai.AuthenticationError as err:
         print(err)
         sys.exit()
+    return client
+
+
+def positive_int(value: str) -> int:
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"must be at least 1, got {number}")
+    return number
 
 
 def main() -> None:
     # read api key
-    authenticate()
+    client = authenticate()
 
     # argument parsing
     parser = argparse.ArgumentParser(
@@ -119,6 +439,7 @@ def main() -> None:
     parser.add_argument(
         "-t",
         "--tries",
+        type=positive_int,
         default=1,
         help="maximum number of tries for AI to generate a valid move, makes no move otherwise",
     )
@@ -128,19 +449,49 @@ def main() -> None:
     board = chess.Board()
     user_side = chess.WHITE if args.white else choice((chess.WHITE, chess.BLACK))
 
+    # the conversation only grows at the tail so every request shares its prefix
+    ai_color = "black" if user_side == chess.WHITE else "white"
+    history = get_ai_prompt(ai_color, str(board))
+    executor = ThreadPoolExecutor(max_workers=1)
+
     # starting user move
     if user_side == chess.WHITE:
         print(render(board))
-        board.push(get_user_move(board))
+        move = get_user_move(board)
+        history.append({"role": "user", "content": f"Move: {board.san(move)}"})
+        board.push(move)
 
     # game loop
-    while not board.is_game_over():
-        move, explanation = get_ai_move(board, args.tries)
-        board.push(move)
-        print(render(board))
-        print("\n")
-        print(explanation)
-        board.push(get_user_move(board))
+    speculation = None
+    try:
+        while not board.is_game_over():
+            move, explanation = get_ai_move(client, board, history, args.tries)
+            # a null move means the AI gave no valid answer, which is not history
+            if move:
+                history.append({"role": "assistant", "content": board.san(move)})
+            board.push(move)
+            print(render(board))
+            print("\n")
+            for text in explanation:
+                print(text, end="", flush=True)
+            print()
+            # let the AI think about the likely reply while the user is thinking
+            speculation = speculate(executor, client, board, history, args.tries)
+            move = get_user_move(board)
+            history.append({"role": "user", "content": f"Move: {board.san(move)}"})
+            board.push(move)
+            if speculation is not None:
+                key, future, stop = speculation
+                if key == cache_key(board):
+                    future.result()
+                else:
+                    stop.set()
+                speculation = None
+    finally:
+        # do not wait for a pending prefetch on quit, interrupt or game over
+        if speculation is not None:
+            speculation[2].set()
+        executor.shutdown(wait=False, cancel_futures=True)
 
     # print outcome
     winner = board.outcome().winner
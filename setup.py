@@ -15,7 +15,7 @@ setup(
     license="MIT License",
     py_modules=["main"],
     python_requires=">=3.9.0",
-    install_requires=["chess==1.9.4", "click==8.1.3", "openai==0.27.2", "rich==13.3.2"],
+    install_requires=["chess==1.9.4", "click==8.1.3", "httpx[http2]==0.27.2", "openai==1.55.3", "rich==13.3.2"],
     entry_points="""
         [console_scripts]
         chess=main:main